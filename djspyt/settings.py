@@ -54,6 +54,27 @@ DATABASES = {
     }
 }
 
+# Локальный полнотекстовый индекс треков для подсказок
+TRACK_INDEX_PATH = BASE_DIR / "track_index.sqlite3"
+
+# Дисковый кэш превью и обложек (media-proxy)
+MEDIA_CACHE_DIR = BASE_DIR / "media_cache"
+MEDIA_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Кэш страниц, результатов поиска и YouTube-совпадений. По умолчанию Django
+# использует LocMemCache - отдельный для каждого процесса. При нескольких
+# воркерах подключите общий кэш, иначе повторные запросы в другой воркер
+# снова тратят квоту Spotify/YouTube:
+# CACHES = {
+#     "default": {
+#         "BACKEND": "django.core.cache.backends.redis.RedisCache",
+#         "LOCATION": "redis://127.0.0.1:6379/1",
+#     }
+# }
+
+# Увеличьте после изменения шаблонов, чтобы сбросить ETag закэшированных страниц
+PAGE_CACHE_VERSION = "1"
+
 AUTH_PASSWORD_VALIDATORS = []
 
 LANGUAGE_CODE = "ru-ru"
@@ -64,3 +85,36 @@ USE_TZ = True
 STATIC_URL = "/static/"
 STATICFILES_DIRS = [BASE_DIR / "search" / "static"]
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+# Ограничение частоты запросов: {endpoint: (запросов в секунду, размер пачки)}
+RATE_LIMITS = {
+    "search": (0.5, 10),
+    "track": (0.5, 10),
+    "audio": (1 / 30, 5),
+    # Обращения подсказок к Spotify при промахе индекса, отдельно от обычного поиска
+    "typeahead": (1, 20),
+}
+# Общие лимиты на всех клиентов сразу
+GLOBAL_RATE_LIMITS = {
+    "search": (5, 50),
+    "track": (5, 50),
+    "audio": (0.5, 10),
+    "typeahead": (5, 50),
+}
+# "memory" - в памяти процесса; либо алиас из CACHES (например, Redis) для общего лимита на все воркеры
+RATE_LIMIT_STORE = "memory"
+
+# Одновременные загрузки+транскодирования на процесс и справедливая очередь к ним
+TRANSCODE_CONCURRENCY = 2
+TRANSCODE_MAX_QUEUED_PER_CLIENT = 2
+TRANSCODE_QUEUE_TIMEOUT = 120  # секунд
+
+# Временные файлы загрузок: маленькие задачи - в tmpfs, большие - на диск
+SCRATCH_SMALL_DIR = "/dev/shm/musicfinder"
+SCRATCH_SMALL_MAX_JOB_BYTES = 64 * 1024 * 1024
+SCRATCH_SMALL_MAX_BYTES = 256 * 1024 * 1024
+# tmpfs занимает оперативную память: оставляем запас свободной
+SCRATCH_SMALL_MIN_FREE_BYTES = 256 * 1024 * 1024
+SCRATCH_DISK_DIR = BASE_DIR / "scratch"
+# Новые загрузки не принимаются, если на диске останется меньше этого
+SCRATCH_MIN_FREE_BYTES = 1024 * 1024 * 1024
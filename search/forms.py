@@ -6,6 +6,7 @@ class SearchForm(forms.Form):
         max_length=300,
         widget=forms.TextInput(attrs={
             "placeholder": "Название или ссылку на трек в Spotify",
-            "class": "input"
+            "class": "input",
+            "autocomplete": "off",
         }),
     )
@@ -0,0 +1,108 @@
+"""
+Ранжирование YouTube-кандидатов под конкретный трек Spotify
+"""
+
+import math
+import re
+from typing import Dict, Any, List, Optional
+from django.core.cache import cache
+from .youtube import search_youtube, get_video_details
+
+# Сколько кандидатов запрашивать (search.list стоит 100 единиц квоты независимо от maxResults)
+CANDIDATES_LIMIT = 10
+MATCH_CACHE_TIMEOUT = 6 * 3600
+# Если videos.list не вернул детали, ранжирование почти случайное - держим его недолго
+MATCH_CACHE_PARTIAL_TIMEOUT = 60
+
+# Слова, которые обычно означают «не та версия», если их нет в названии трека
+_UNWANTED_WORDS = [
+    "live", "cover", "karaoke", "remix", "instrumental", "acoustic",
+    "sped up", "slowed", "nightcore", "8d", "reverb", "loop", "hour", "hours",
+    "reaction", "tutorial", "lesson",
+]
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _tokens(text: str) -> List[str]:
+    return _WORD_RE.findall((text or "").lower())
+
+
+def _contains_phrase(tokens: List[str], phrase: str) -> bool:
+    words = phrase.split()
+    n = len(words)
+    return any(tokens[i:i + n] == words for i in range(len(tokens) - n + 1))
+
+
+def score_candidate(candidate: Dict[str, Any], meta: Dict[str, Any]) -> float:
+    """Оценка похожести видео на трек: длительность, название, артист, популярность"""
+    title_tokens = _tokens(candidate.get("title"))
+    channel = (candidate.get("channel") or "").lower()
+    name_tokens = _tokens(re.sub(r"\s*[\(\[].*?[\)\]]", "", meta.get("name") or ""))
+    full_name_tokens = _tokens(meta.get("name"))
+    artists = [a.strip().lower() for a in (meta.get("artists") or "").split(",") if a.strip()]
+    score = 0.0
+
+    # Длительность - самый надёжный признак: live-версии, каверы и лупы почти всегда длиннее
+    target = (meta.get("duration_ms") or 0) / 1000
+    duration = candidate.get("duration")
+    if target and duration:
+        diff = abs(duration - target)
+        if diff <= 3:
+            score += 40
+        else:
+            score += 40 * max(0.0, 1 - (diff - 3) / 30)
+        if duration > target * 2:
+            score -= 30
+
+    # Название трека в заголовке видео
+    if name_tokens:
+        present = sum(1 for t in name_tokens if t in title_tokens)
+        score += 25 * present / len(name_tokens)
+
+    # Артист в заголовке или в названии канала
+    if artists:
+        main_artist = artists[0]
+        if _contains_phrase(title_tokens, " ".join(_tokens(main_artist))) or main_artist in channel:
+            score += 15
+        # Официальные каналы: «Artist - Topic» и VEVO
+        if channel.endswith(" - topic") or "vevo" in channel:
+            score += 10
+
+    for word in _UNWANTED_WORDS:
+        if _contains_phrase(title_tokens, word) and not _contains_phrase(full_name_tokens, word):
+            score -= 20
+
+    views = candidate.get("view_count") or 0
+    score += min(10.0, math.log10(views + 1))
+    return round(score, 1)
+
+
+def find_youtube_matches(meta: Dict[str, Any], limit: int = 6) -> List[Dict[str, Any]]:
+    """
+    Кандидаты с YouTube для трека, отсортированные по оценке.
+    Первый элемент помечен как best. Результат кэшируется по id трека;
+    без деталей хотя бы одного видео - только на MATCH_CACHE_PARTIAL_TIMEOUT.
+    """
+    cache_key = f"yt_matches:{meta['id']}"
+    ranked = cache.get(cache_key)
+    if ranked is None:
+        yt_query = f"{meta['artists']} - {meta['name']}"
+        candidates = search_youtube(yt_query, limit=CANDIDATES_LIMIT)
+        details = get_video_details([c["video_id"] for c in candidates]) if candidates else {}
+        for c in candidates:
+            c.update(details.get(c["video_id"], {}))
+            c["score"] = score_candidate(c, meta)
+        # sorted стабилен, поэтому при равных оценках сохраняется порядок YouTube
+        ranked = sorted(candidates, key=lambda c: c["score"], reverse=True)
+        for i, c in enumerate(ranked):
+            c["best"] = i == 0
+        if ranked:
+            complete = all(c["video_id"] in details for c in candidates)
+            cache.set(cache_key, ranked, MATCH_CACHE_TIMEOUT if complete else MATCH_CACHE_PARTIAL_TIMEOUT)
+    return ranked[:limit]
+
+
+def get_best_match(meta: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Лучший YouTube-кандидат для трека или None"""
+    matches = find_youtube_matches(meta, limit=1)
+    return matches[0] if matches else None
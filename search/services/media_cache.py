@@ -0,0 +1,209 @@
+"""
+Дисковый кэш превью (30 с клипы) и обложек со сторонних CDN
+"""
+
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+from typing import Dict, Any, Optional, Tuple
+import requests
+from django.conf import settings
+from django.urls import reverse
+from .metrics import metrics
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow не обязателен: без него обложки отдаются в исходном размере
+    Image = None
+
+# Откуда разрешено проксировать (защита от SSRF)
+ALLOWED_HOST_SUFFIXES = ("scdn.co", "dzcdn.net", "ytimg.com")
+# Размеры, до которых можно уменьшать обложки (px, с учётом 2x экранов)
+ALLOWED_SIZES = (72, 112, 192)
+MAX_UPSTREAM_BYTES = 10 * 1024 * 1024
+_MAX_REDIRECTS = 3
+# Повторно трогаем файл (для LRU) не чаще, чем раз в это число секунд
+_TOUCH_INTERVAL = 3600
+
+
+class MediaFetchError(Exception):
+    """Не удалось получить файл с CDN"""
+
+
+def is_allowed_url(url: str) -> bool:
+    parsed = urllib.parse.urlsplit(url or "")
+    host = (parsed.hostname or "").lower()
+    return parsed.scheme in ("http", "https") and any(
+        host == suffix or host.endswith("." + suffix) for suffix in ALLOWED_HOST_SUFFIXES
+    )
+
+
+def proxied_url(url: Optional[str], size: Optional[int] = None) -> Optional[str]:
+    """URL через наш кэширующий прокси; чужие и пустые URL возвращаются как есть"""
+    if not url or not is_allowed_url(url):
+        return url
+    params = {"url": url}
+    if size in ALLOWED_SIZES:
+        params["size"] = size
+    return f"{reverse('media_proxy')}?{urllib.parse.urlencode(params)}"
+
+
+class MediaCache:
+    """
+    Файлы лежат в <root>/<key[:2]>/<key>, метаданные - рядом в <key>.json.
+    Ключ строится без query string: у Deezer и Spotify в ней подписи,
+    которые меняются от запроса к запросу, а сам клип определяется путём.
+    Общий размер ограничен max_bytes, вытесняются давно не использованные файлы.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = str(root)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total_bytes = None
+
+    def _key(self, url: str, size: Optional[int]) -> str:
+        parsed = urllib.parse.urlsplit(url)
+        base = f"{parsed.hostname}{parsed.path}|{size or ''}"
+        return hashlib.sha256(base.encode()).hexdigest()
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        directory = os.path.join(self.root, key[:2])
+        return os.path.join(directory, key), os.path.join(directory, key + ".json")
+
+    def get(self, url: str, size: Optional[int] = None) -> Tuple[str, Dict[str, Any]]:
+        """Вернуть (путь к файлу, метаданные), при промахе скачав файл с CDN"""
+        key = self._key(url, size)
+        path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            st = os.stat(path)
+            metrics.incr('media_cache_hits')
+            if time.time() - st.st_mtime > _TOUCH_INTERVAL:
+                os.utime(path)
+            return path, meta
+        except (OSError, ValueError):
+            pass
+
+        metrics.incr('media_cache_misses')
+        data, content_type = self._fetch(url)
+        if size and Image is not None and content_type.startswith("image/"):
+            data, content_type = _resize_image(data, content_type, size)
+        meta = {
+            "content_type": content_type,
+            "etag": '"%s"' % hashlib.sha256(data).hexdigest()[:32],
+            "last_modified": time.time(),
+            "size": len(data),
+        }
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _atomic_write(path, data)
+        _atomic_write(meta_path, json.dumps(meta).encode())
+        self._account(len(data))
+        return path, meta
+
+    def _fetch(self, url: str) -> Tuple[bytes, str]:
+        # Редиректы проходим вручную, чтобы каждый адрес тоже был из разрешённых
+        for _ in range(_MAX_REDIRECTS + 1):
+            try:
+                with requests.get(url, timeout=10, stream=True, allow_redirects=False) as resp:
+                    if resp.is_redirect:
+                        url = urllib.parse.urljoin(url, resp.headers.get("Location", ""))
+                        if not is_allowed_url(url):
+                            raise MediaFetchError("Редирект на недопустимый адрес")
+                        continue
+                    resp.raise_for_status()
+                    chunks = []
+                    received = 0
+                    for chunk in resp.iter_content(64 * 1024):
+                        received += len(chunk)
+                        if received > MAX_UPSTREAM_BYTES:
+                            raise MediaFetchError("Файл слишком большой")
+                        chunks.append(chunk)
+                    content_type = resp.headers.get("Content-Type", "application/octet-stream").split(";")[0]
+                    return b"".join(chunks), content_type
+            except requests.exceptions.RequestException as e:
+                raise MediaFetchError(str(e))
+        raise MediaFetchError("Слишком много редиректов")
+
+    def _account(self, added: int):
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self._scan_size()
+            else:
+                self._total_bytes += added
+            if self._total_bytes > self.max_bytes:
+                self._total_bytes = self._evict()
+            metrics.set_gauge('media_cache_bytes', self._total_bytes)
+
+    def _files(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if not name.endswith(".json") and not name.endswith(".tmp"):
+                    path = os.path.join(dirpath, name)
+                    try:
+                        yield path, os.stat(path)
+                    except OSError:
+                        continue
+
+    def _scan_size(self) -> int:
+        return sum(st.st_size for _, st in self._files())
+
+    def _evict(self) -> int:
+        """Удалить самые старые файлы, пока кэш не станет меньше 90% лимита"""
+        # Пересчитываем по диску: другие воркеры тоже пишут в кэш
+        files = sorted(self._files(), key=lambda item: item[1].st_mtime)
+        total = sum(st.st_size for _, st in files)
+        target = self.max_bytes * 0.9
+        for path, st in files:
+            if total <= target:
+                break
+            for p in (path, path + ".json"):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            total -= st.st_size
+            metrics.incr('media_cache_evictions')
+        return total
+
+
+def _atomic_write(path: str, data: bytes):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _resize_image(data: bytes, content_type: str, size: int) -> Tuple[bytes, str]:
+    """Уменьшить обложку до size x size (с сохранением пропорций)"""
+    try:
+        img = Image.open(io.BytesIO(data))
+        if img.width <= size and img.height <= size:
+            return data, content_type
+        img.thumbnail((size, size))
+        out = io.BytesIO()
+        img.convert("RGB").save(out, "JPEG", quality=85, optimize=True)
+        return out.getvalue(), "image/jpeg"
+    except Exception as e:
+        print(f"Ошибка уменьшения обложки: {e}")
+        return data, content_type
+
+
+# Глобальный экземпляр кэша
+media_cache = MediaCache(
+    getattr(settings, "MEDIA_CACHE_DIR", settings.BASE_DIR / "media_cache"),
+    getattr(settings, "MEDIA_CACHE_MAX_BYTES", 512 * 1024 * 1024),
+)
@@ -0,0 +1,36 @@
+"""
+Простые in-process метрики (счётчики и gauge-значения)
+"""
+
+import threading
+from typing import Dict
+
+
+class Metrics:
+    """Потокобезопасное хранилище счётчиков и текущих значений"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, int] = {}
+        self.gauges: Dict[str, float] = {}
+
+    def incr(self, name: str, value: int = 1):
+        """Увеличить счётчик"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float):
+        """Установить текущее значение"""
+        with self._lock:
+            self.gauges[name] = value
+
+    def snapshot(self) -> dict:
+        """Получить копию всех метрик"""
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+            }
+
+# Глобальный экземпляр метрик
+metrics = Metrics()
@@ -0,0 +1,74 @@
+"""
+Кэш отрендеренных страниц с ETag/304 и заголовками для reverse proxy
+"""
+
+import hashlib
+import json
+from typing import Any, Callable, Dict, Tuple, Union
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpRequest, HttpResponse
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response
+from .metrics import metrics
+
+# Меняется при изменении шаблонов, чтобы старые ETag перестали совпадать
+PAGE_CACHE_VERSION = getattr(settings, "PAGE_CACHE_VERSION", "1")
+
+
+def _etag(data: Any) -> str:
+    payload = json.dumps(data, sort_keys=True, default=str, ensure_ascii=False)
+    digest = hashlib.sha256(f"{PAGE_CACHE_VERSION}|{payload}".encode()).hexdigest()[:32]
+    return f'"{digest}"'
+
+
+def cached_page(
+    request: HttpRequest,
+    view_name: str,
+    key: str,
+    build: Callable[[], Union[HttpResponse, Tuple[Dict[str, Any], int, Any]]],
+    template: str,
+    max_age: int,
+) -> HttpResponse:
+    """
+    Отдать страницу из кэша или собрать её через build().
+
+    build() возвращает (context, timeout, etag_data) - timeout 0 означает
+    «не кэшировать» (например, страница с ошибкой) - или готовый HttpResponse
+    (редирект, 429). ETag считается по etag_data: в нём должны быть только
+    стабильные поля (id, названия, длительности, порядок видео), без подписанных
+    URL и счётчиков просмотров. Тогда пересобранная страница, например в другом
+    воркере, получает тот же ETag, и запрос с If-None-Match получает 304.
+    """
+    cache_key = f"page:{view_name}:{hashlib.sha256(key.encode()).hexdigest()}"
+    entry = cache.get(cache_key)
+    if entry is None:
+        metrics.incr(f'page_cache_misses_{view_name}')
+        result = build()
+        if isinstance(result, HttpResponse):
+            return result
+        context, timeout, etag_data = result
+        entry = {
+            "etag": _etag(etag_data),
+            "content": render_to_string(template, context, request),
+            "cacheable": timeout > 0,
+        }
+        if timeout > 0:
+            cache.set(cache_key, entry, timeout)
+    else:
+        metrics.incr(f'page_cache_hits_{view_name}')
+
+    if entry["cacheable"]:
+        cache_control = f"public, max-age={max_age}, stale-while-revalidate={max_age * 5}"
+    else:
+        cache_control = "no-cache"
+
+    resp = HttpResponse(entry["content"])
+    resp["ETag"] = entry["etag"]
+    resp["Cache-Control"] = cache_control
+    resp["Vary"] = "Accept-Encoding"
+    # Django сравнивает If-None-Match слабо (W/"x" совпадает с "x") и переносит заголовки в 304
+    resp = get_conditional_response(request, etag=entry["etag"], response=resp)
+    if resp.status_code == 304:
+        metrics.incr(f'page_cache_not_modified_{view_name}')
+    return resp
@@ -0,0 +1,239 @@
+"""
+Ограничение частоты запросов (token bucket) и справедливая очередь транскодирования
+"""
+
+import heapq
+import itertools
+import math
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpRequest, HttpResponse
+from .metrics import metrics
+
+# {scope: (токенов в секунду, размер пачки)} - на одного клиента
+DEFAULT_RATE_LIMITS = {
+    'search': (0.5, 10),
+    'track': (0.5, 10),
+    'audio': (1 / 30, 5),
+    'typeahead': (1, 20),
+}
+# {scope: (токенов в секунду, размер пачки)} - на всех клиентов вместе
+DEFAULT_GLOBAL_RATE_LIMITS = {
+    'search': (5, 50),
+    'track': (5, 50),
+    'audio': (0.5, 10),
+    'typeahead': (5, 50),
+}
+
+
+def get_client_id(request: HttpRequest) -> str:
+    """Идентификатор клиента: IP (за nginx - из X-Real-IP), иначе сессия"""
+    ip = request.META.get('HTTP_X_REAL_IP') or request.META.get('REMOTE_ADDR')
+    if ip:
+        return ip
+    session = getattr(request, 'session', None)
+    if session is not None and session.session_key:
+        return f"session:{session.session_key}"
+    return 'anonymous'
+
+
+class MemoryBucketStore:
+    """Хранилище бакетов в памяти процесса"""
+
+    # Как часто выбрасывать полностью восстановившиеся бакеты (секунды)
+    PRUNE_INTERVAL = 60
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {key: (токены, время обновления, скорость, размер пачки)}
+        self._buckets: Dict[str, Tuple[float, float, float, int]] = {}
+        self._last_prune = time.monotonic()
+
+    def take(self, key: str, rate: float, burst: int) -> Tuple[bool, float, float]:
+        """Взять токен. Возвращает (разрешено, осталось токенов, секунд до следующего токена)"""
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated, _, _ = self._buckets.get(key, (float(burst), now, rate, burst))
+            tokens = min(float(burst), tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now, rate, burst)
+            if now - self._last_prune > self.PRUNE_INTERVAL:
+                self._prune(now)
+        return allowed, tokens, (1 - tokens) / rate if tokens < 1 else 0.0
+
+    def _prune(self, now: float):
+        """Полный бакет ничем не отличается от нового, его можно забыть"""
+        self._buckets = {
+            key: bucket for key, bucket in self._buckets.items()
+            if bucket[0] + (now - bucket[1]) * bucket[2] < bucket[3]
+        }
+        self._last_prune = now
+
+
+class CacheBucketStore:
+    """
+    Хранилище бакетов в кэше Django (Redis/Memcached), общее для всех воркеров.
+    Чтение-изменение-запись не атомарно, поэтому при гонке лимит может быть
+    превышен на несколько запросов - для защиты от скриптов этого достаточно.
+    """
+
+    def __init__(self, alias: str):
+        self.cache = caches[alias]
+
+    def take(self, key: str, rate: float, burst: int) -> Tuple[bool, float, float]:
+        cache_key = f"ratelimit:{key}"
+        now = time.time()
+        tokens, updated = self.cache.get(cache_key) or (float(burst), now)
+        tokens = min(float(burst), tokens + max(now - updated, 0) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        # Бакет, простоявший дольше полного восстановления, можно забыть
+        self.cache.set(cache_key, (tokens, now), timeout=math.ceil(burst / rate) + 1)
+        return allowed, tokens, (1 - tokens) / rate if tokens < 1 else 0.0
+
+
+class RateLimiter:
+    """Token bucket на клиента и на весь сервис для каждого endpoint'а"""
+
+    def __init__(self):
+        self.limits = getattr(settings, 'RATE_LIMITS', DEFAULT_RATE_LIMITS)
+        self.global_limits = getattr(settings, 'GLOBAL_RATE_LIMITS', DEFAULT_GLOBAL_RATE_LIMITS)
+        store = getattr(settings, 'RATE_LIMIT_STORE', 'memory')
+        self.store = MemoryBucketStore() if store == 'memory' else CacheBucketStore(store)
+
+    def check(self, request: HttpRequest, scope: str) -> Optional[HttpResponse]:
+        """Вернуть ответ 429, если лимит исчерпан, иначе None"""
+        client_id = get_client_id(request)
+        checks = []
+        if scope in self.limits:
+            checks.append(('client', f"{scope}:{client_id}", *self.limits[scope]))
+        if scope in self.global_limits:
+            checks.append(('global', f"{scope}:*", *self.global_limits[scope]))
+
+        for kind, key, rate, burst in checks:
+            allowed, remaining, retry_after = self.store.take(key, rate, burst)
+            if not allowed:
+                metrics.incr(f'ratelimit_rejected_{scope}_{kind}')
+                return _too_many_requests(scope, kind, rate, burst, retry_after)
+        return None
+
+
+def _too_many_requests(scope: str, kind: str, rate: float, burst: int, retry_after: float) -> HttpResponse:
+    retry_after = max(1, math.ceil(retry_after))
+    if kind == 'client':
+        message = f"Слишком много запросов. Повторите через {retry_after} с."
+    else:
+        message = f"Сервис перегружен. Повторите через {retry_after} с."
+    resp = HttpResponse(message, status=429, content_type="text/plain; charset=utf-8")
+    resp["Retry-After"] = str(retry_after)
+    resp["X-RateLimit-Scope"] = f"{scope}:{kind}"
+    resp["X-RateLimit-Limit"] = f"{burst};w={math.ceil(burst / rate)}"
+    resp["X-RateLimit-Remaining"] = "0"
+    return resp
+
+
+class QueueFull(Exception):
+    """У клиента уже слишком много задач в очереди"""
+
+
+class QueueTimeout(Exception):
+    """Задача не дождалась свободного слота"""
+
+
+class FairScheduler:
+    """
+    Weighted fair queuing для тяжёлых задач (загрузка + ffmpeg).
+
+    Каждой задаче присваивается виртуальное время окончания
+    max(V, last_finish[client]) + cost / weight; свободный слот получает задача
+    с наименьшим значением. Клиент, поставивший в очередь много задач,
+    не может обогнать тех, кто ждёт свою первую.
+    Очередь живёт в памяти процесса: при нескольких воркерах gunicorn у каждого
+    своя очередь, и общий предел равен workers × slots.
+    """
+
+    def __init__(self, slots: int, max_queued_per_client: int):
+        self.slots = slots
+        self.max_queued_per_client = max_queued_per_client
+        self._cond = threading.Condition()
+        self._running = 0
+        self._virtual_time = 0.0
+        self._last_finish: Dict[str, float] = {}
+        self._queued: Dict[str, int] = {}
+        self._heap = []
+        self._seq = itertools.count()
+
+    def acquire(self, client_id: str, weight: float = 1.0, cost: float = 1.0,
+                timeout: Optional[float] = None, cancel_check=None) -> bool:
+        """
+        Дождаться слота. Возвращает False, если ожидание отменено через cancel_check;
+        бросает QueueFull или QueueTimeout
+        """
+        with self._cond:
+            if self._queued.get(client_id, 0) >= self.max_queued_per_client:
+                metrics.incr('transcode_queue_rejected')
+                raise QueueFull(client_id)
+            finish = max(self._virtual_time, self._last_finish.get(client_id, 0.0)) + cost / weight
+            self._last_finish[client_id] = finish
+            entry = (finish, next(self._seq))
+            heapq.heappush(self._heap, entry)
+            self._queued[client_id] = self._queued.get(client_id, 0) + 1
+            self._update_gauges()
+            deadline = time.monotonic() + timeout if timeout else None
+            try:
+                while self._running >= self.slots or self._heap[0] != entry:
+                    if cancel_check and cancel_check():
+                        self._remove(entry)
+                        return False
+                    if deadline and time.monotonic() >= deadline:
+                        metrics.incr('transcode_queue_timeouts')
+                        raise QueueTimeout(client_id)
+                    self._cond.wait(0.5)
+            except BaseException:
+                self._remove(entry)
+                raise
+            finally:
+                self._queued[client_id] -= 1
+                if not self._queued[client_id]:
+                    del self._queued[client_id]
+                self._update_gauges()
+            heapq.heappop(self._heap)
+            self._virtual_time = finish
+            self._running += 1
+            self._update_gauges()
+            return True
+
+    def _remove(self, entry):
+        """Убрать задачу из очереди (вызывается под блокировкой)"""
+        self._heap.remove(entry)
+        heapq.heapify(self._heap)
+        self._cond.notify_all()
+
+    def release(self):
+        """Освободить слот"""
+        with self._cond:
+            self._running -= 1
+            # Забываем клиентов, которые уже отстали от виртуального времени
+            for client_id, finish in list(self._last_finish.items()):
+                if finish <= self._virtual_time and client_id not in self._queued:
+                    del self._last_finish[client_id]
+            self._update_gauges()
+            self._cond.notify_all()
+
+    def _update_gauges(self):
+        metrics.set_gauge('transcode_running', self._running)
+        metrics.set_gauge('transcode_queued', len(self._heap))
+
+
+# Глобальные экземпляры
+rate_limiter = RateLimiter()
+transcode_scheduler = FairScheduler(
+    slots=getattr(settings, 'TRANSCODE_CONCURRENCY', 2),
+    max_queued_per_client=getattr(settings, 'TRANSCODE_MAX_QUEUED_PER_CLIENT', 2),
+)
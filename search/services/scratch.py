@@ -0,0 +1,225 @@
+"""
+Менеджер временного места для загрузок: tmpfs для маленьких задач, диск для больших
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+from django.conf import settings
+from .metrics import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows: резервирование согласовано только внутри процесса
+    fcntl = None
+
+_JOB_PREFIX = "job-"
+_LOCK_NAME = ".lock"
+# Каталоги задач старше этого считаются брошенными, даже если pid занят другим процессом
+_ORPHAN_MAX_AGE = 6 * 3600
+
+
+class ScratchSpaceFull(Exception):
+    """Недостаточно места для новой задачи"""
+
+
+def _parse_job_name(name: str) -> Optional[Tuple[int, int]]:
+    """job-<pid>-<зарезервировано байт>-<id> -> (pid, байты)"""
+    if not name.startswith(_JOB_PREFIX):
+        return None
+    parts = name[len(_JOB_PREFIX):].split("-")
+    try:
+        return int(parts[0]), int(parts[1])
+    except (IndexError, ValueError):
+        return None
+
+
+class ScratchTier:
+    """
+    Один каталог для временных файлов со своими ограничениями.
+
+    Резерв хранится в имени каталога задачи, поэтому его видят все воркеры:
+    занятое место - это сумма резервов всех job-каталогов уровня.
+    Проверка и создание каталога идут под flock, чтобы два процесса
+    не заняли одно и то же место.
+    """
+
+    def __init__(self, name: str, path: str, max_job_bytes: Optional[int],
+                 max_bytes: Optional[int], min_free_bytes: int):
+        self.name = name
+        self.path = str(path)
+        self.max_job_bytes = max_job_bytes
+        self.max_bytes = max_bytes
+        self.min_free_bytes = min_free_bytes
+
+    def reserved_bytes(self) -> int:
+        """Сумма резервов всех задач уровня во всех процессах"""
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return 0
+        return sum(parsed[1] for parsed in map(_parse_job_name, names) if parsed)
+
+    def can_fit(self, size: int, reserved: int) -> bool:
+        if self.max_job_bytes is not None and size > self.max_job_bytes:
+            return False
+        if self.max_bytes is not None and reserved + size > self.max_bytes:
+            return False
+        try:
+            free = shutil.disk_usage(self.path).free
+        except OSError:
+            return False
+        # Зарезервированное место ещё не записано на диск целиком, но скоро будет
+        return free - reserved - size >= self.min_free_bytes
+
+    @contextmanager
+    def locked(self):
+        """Межпроцессная блокировка уровня"""
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.path, _LOCK_NAME), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class ScratchSpace:
+    """
+    Выдаёт каталоги под задачи с резервированием места.
+
+    Задача получает первый уровень, в который помещается её оценка размера;
+    если не помещается никуда - ScratchSpaceFull. Каталог задачи содержит pid
+    владельца, по которому удаляются каталоги убитых воркеров. Каталоги
+    уровней создаются, а брошенные задачи вычищаются при первой задаче процесса,
+    а не при импорте.
+    """
+
+    def __init__(self, tiers: List[ScratchTier]):
+        self.tiers = tiers
+        self._lock = threading.Lock()
+        self._ready = False
+        self._peak = 0
+
+    def _ensure_ready(self):
+        """Создать каталоги уровней (недоступные уровни отключаются) и убрать мусор"""
+        if self._ready:
+            return
+        usable = []
+        for tier in self.tiers:
+            try:
+                os.makedirs(tier.path, exist_ok=True)
+                usable.append(tier)
+            except OSError as e:
+                print(f"❌ Временный каталог {tier.path} недоступен, уровень {tier.name} отключён: {e}")
+        self.tiers = usable
+        self._ready = True
+        self.sweep_orphans()
+
+    @contextmanager
+    def job(self, estimated_bytes: int):
+        """Зарезервировать место и выдать каталог задачи; каталог удаляется при выходе"""
+        job_dir = self._reserve(estimated_bytes)
+        try:
+            yield job_dir
+        finally:
+            # Удаление каталога одновременно снимает резерв
+            shutil.rmtree(job_dir, ignore_errors=True)
+            self._update_gauges()
+
+    def _reserve(self, size: int) -> str:
+        with self._lock:
+            self._ensure_ready()
+            for tier in self.tiers:
+                try:
+                    with tier.locked():
+                        if not tier.can_fit(size, tier.reserved_bytes()):
+                            continue
+                        job_dir = os.path.join(
+                            tier.path, f"{_JOB_PREFIX}{os.getpid()}-{size}-{uuid.uuid4().hex[:12]}"
+                        )
+                        os.makedirs(job_dir)
+                except OSError as e:
+                    print(f"❌ Ошибка резервирования в {tier.path}: {e}")
+                    continue
+                metrics.incr(f'scratch_jobs_{tier.name}')
+                self._update_gauges()
+                return job_dir
+        metrics.incr('scratch_rejected')
+        raise ScratchSpaceFull(f"Нет места для задачи на {size // (1024 * 1024)} МБ")
+
+    def _update_gauges(self):
+        per_tier = {t.name: t.reserved_bytes() for t in self.tiers}
+        in_flight = sum(per_tier.values())
+        self._peak = max(self._peak, in_flight)
+        metrics.set_gauge('scratch_in_flight_bytes', in_flight)
+        metrics.set_gauge('scratch_peak_bytes', self._peak)
+        for name, reserved in per_tier.items():
+            metrics.set_gauge(f'scratch_in_flight_bytes_{name}', reserved)
+
+    def sweep_orphans(self) -> int:
+        """Удалить каталоги задач, чьи процессы уже не существуют"""
+        removed = 0
+        for tier in self.tiers:
+            try:
+                entries = os.listdir(tier.path)
+            except OSError:
+                continue
+            for name in entries:
+                parsed = _parse_job_name(name)
+                if not parsed:
+                    continue
+                pid = parsed[0]
+                path = os.path.join(tier.path, name)
+                try:
+                    age = time.time() - os.stat(path).st_mtime
+                except OSError:
+                    continue
+                if pid != os.getpid() and (not _pid_alive(pid) or age > _ORPHAN_MAX_AGE):
+                    shutil.rmtree(path, ignore_errors=True)
+                    removed += 1
+        if removed:
+            print(f"🧹 Удалено брошенных временных каталогов: {removed}")
+            metrics.incr('scratch_orphans_swept', removed)
+        return removed
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _default_tiers() -> List[ScratchTier]:
+    tiers = []
+    small_dir = getattr(settings, "SCRATCH_SMALL_DIR", "/dev/shm/musicfinder")
+    if small_dir and os.path.isdir(os.path.dirname(str(small_dir))):
+        tiers.append(ScratchTier(
+            "tmpfs", small_dir,
+            max_job_bytes=getattr(settings, "SCRATCH_SMALL_MAX_JOB_BYTES", 64 * 1024 * 1024),
+            max_bytes=getattr(settings, "SCRATCH_SMALL_MAX_BYTES", 256 * 1024 * 1024),
+            # tmpfs - это оперативная память, её нельзя занимать до конца
+            min_free_bytes=getattr(settings, "SCRATCH_SMALL_MIN_FREE_BYTES", 256 * 1024 * 1024),
+        ))
+    tiers.append(ScratchTier(
+        "disk", getattr(settings, "SCRATCH_DISK_DIR", os.path.join(tempfile.gettempdir(), "musicfinder")),
+        max_job_bytes=None,
+        max_bytes=getattr(settings, "SCRATCH_DISK_MAX_BYTES", None),
+        min_free_bytes=getattr(settings, "SCRATCH_MIN_FREE_BYTES", 1024 * 1024 * 1024),
+    ))
+    return tiers
+
+
+# Глобальный экземпляр; каталоги создаются и чистятся при первой задаче
+scratch_space = ScratchSpace(_default_tiers())
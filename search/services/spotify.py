@@ -6,6 +6,7 @@ import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
 from djspyt import keys
 from .deezer import get_enhanced_preview
+from .track_index import index_tracks
 
 # Инициализация Spotify клиента
 client_credentials_manager = SpotifyClientCredentials(
@@ -29,9 +30,12 @@ def search_tracks(query: str, limit: int = 10) -> List[Dict[str, Any]]:
                 "album": item.get("album", {}).get("name"),
                 "image": (item.get("album", {}).get("images") or [{}])[0].get("url"),
                 "duration_ms": item.get("duration_ms"),
+                "popularity": item.get("popularity"),
                 "preview_url": item.get("preview_url"),
                 "external_url": item.get("external_urls", {}).get("spotify"),
             })
+        # Запоминаем треки для локальных подсказок
+        index_tracks(tracks)
         return tracks
     except Exception as e:
         print(f"Ошибка поиска треков: {e}")
@@ -73,6 +77,8 @@ def get_track_metadata(track_id: str) -> Dict[str, Any]:
         else:
             meta["preview_source"] = "Spotify"
         
+        # Открытый трек поднимается выше в локальных подсказках
+        index_tracks([meta], hit=True)
         return meta
     except Exception as e:
         print(f"Ошибка получения метаданных трека: {e}")
@@ -0,0 +1,143 @@
+"""
+Локальный полнотекстовый индекс уже виденных треков (SQLite FTS5) для мгновенных подсказок
+"""
+
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Any, Iterable, List
+from django.conf import settings
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    artists TEXT,
+    album TEXT,
+    image TEXT,
+    duration_ms INTEGER,
+    popularity INTEGER,
+    external_url TEXT,
+    hits INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+    name, artists, album,
+    content='tracks', content_rowid='rowid',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS tracks_ai AFTER INSERT ON tracks BEGIN
+    INSERT INTO tracks_fts(rowid, name, artists, album) VALUES (new.rowid, new.name, new.artists, new.album);
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_ad AFTER DELETE ON tracks BEGIN
+    INSERT INTO tracks_fts(tracks_fts, rowid, name, artists, album) VALUES ('delete', old.rowid, old.name, old.artists, old.album);
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_au AFTER UPDATE OF name, artists, album ON tracks BEGIN
+    INSERT INTO tracks_fts(tracks_fts, rowid, name, artists, album) VALUES ('delete', old.rowid, old.name, old.artists, old.album);
+    INSERT INTO tracks_fts(rowid, name, artists, album) VALUES (new.rowid, new.name, new.artists, new.album);
+END;
+"""
+
+_UPSERT = """
+INSERT INTO tracks (id, name, artists, album, image, duration_ms, popularity, external_url, hits, updated_at)
+VALUES (:id, :name, :artists, :album, :image, :duration_ms, :popularity, :external_url, :hits, :updated_at)
+ON CONFLICT(id) DO UPDATE SET
+    name = excluded.name,
+    artists = excluded.artists,
+    album = excluded.album,
+    image = COALESCE(excluded.image, tracks.image),
+    duration_ms = COALESCE(excluded.duration_ms, tracks.duration_ms),
+    popularity = COALESCE(excluded.popularity, tracks.popularity),
+    external_url = COALESCE(excluded.external_url, tracks.external_url),
+    hits = tracks.hits + excluded.hits,
+    updated_at = excluded.updated_at
+"""
+
+# bm25: меньше - лучше; вес полей name > artists > album.
+# Популярность Spotify и число открытий трека у нас поднимают результат выше.
+_SEARCH = """
+SELECT t.id, t.name, t.artists, t.album, t.image, t.duration_ms, t.popularity, t.external_url
+FROM tracks_fts
+JOIN tracks t ON t.rowid = tracks_fts.rowid
+WHERE tracks_fts MATCH ?
+ORDER BY bm25(tracks_fts, 10.0, 5.0, 1.0) - COALESCE(t.popularity, 0) / 20.0 - min(t.hits, 50) / 10.0
+LIMIT ?
+"""
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def build_match_query(text: str) -> str:
+    """Превращает ввод пользователя в запрос FTS5: все слова обязательны, последнее - по префиксу"""
+    words = _WORD_RE.findall((text or "").lower())
+    if not words:
+        return ""
+    terms = [f'"{w}"' for w in words[:-1]]
+    terms.append(f'"{words[-1]}"*')
+    return " ".join(terms)
+
+
+class TrackIndex:
+    """Индекс треков в отдельной SQLite базе; соединение на поток"""
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.row_factory = sqlite3.Row
+            # WAL позволяет воркерам gunicorn читать, пока кто-то пишет
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with self._init_lock:
+                if not self._initialized:
+                    conn.executescript(_SCHEMA)
+                    self._initialized = True
+            self._local.conn = conn
+        return conn
+
+    def add_tracks(self, tracks: Iterable[Dict[str, Any]], hit: bool = False):
+        """Добавить или обновить треки (hit=True - трек открыли, он станет выше в подсказках)"""
+        now = time.time()
+        rows = [{
+            "id": t["id"],
+            "name": t.get("name") or "",
+            "artists": t.get("artists"),
+            "album": t.get("album"),
+            "image": t.get("image"),
+            "duration_ms": t.get("duration_ms"),
+            "popularity": t.get("popularity"),
+            "external_url": t.get("external_url"),
+            "hits": 1 if hit else 0,
+            "updated_at": now,
+        } for t in tracks if t.get("id")]
+        if not rows:
+            return
+        conn = self._connection()
+        with conn:
+            conn.executemany(_UPSERT, rows)
+
+    def search(self, text: str, limit: int = 8) -> List[Dict[str, Any]]:
+        """Поиск по индексу с префиксным совпадением"""
+        match = build_match_query(text)
+        if not match:
+            return []
+        rows = self._connection().execute(_SEARCH, (match, limit)).fetchall()
+        return [dict(r) for r in rows]
+
+
+def index_tracks(tracks: Iterable[Dict[str, Any]], hit: bool = False):
+    """Добавить треки в индекс; ошибки индекса не должны ломать поиск"""
+    try:
+        track_index.add_tracks(tracks, hit=hit)
+    except Exception as e:
+        print(f"Ошибка индексации треков: {e}")
+
+# Глобальный экземпляр индекса
+track_index = TrackIndex(getattr(settings, "TRACK_INDEX_PATH", settings.BASE_DIR / "track_index.sqlite3"))
@@ -1,4 +1,4 @@
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 import requests
 import re
 from .youtube_key_manager import key_manager
@@ -46,26 +46,85 @@ def search_youtube(query: str, limit: int = 6) -> List[Dict[str, Any]]:
 
 def _search_youtube_single(query: str, limit: int) -> List[Dict[str, Any]]:
     """Выполняет один поисковый запрос к YouTube API с автоматической ротацией ключей"""
+    params = {
+        "part": "snippet",
+        "q": query,
+        "maxResults": limit,
+        "type": "video",
+        "safeSearch": "none",
+        "relevanceLanguage": "en",
+    }
+    data = _youtube_api_get("search", params, f"запроса '{query}'")
+    if data is None:
+        return []
+
+    results = []
+    for item in data.get("items", []):
+        vid = item["id"]["videoId"]
+        sn = item["snippet"]
+        results.append({
+            "video_id": vid,
+            "title": sn.get("title"),
+            "channel": sn.get("channelTitle"),
+            "published_at": sn.get("publishedAt"),
+            "thumbnail": (sn.get("thumbnails", {}).get("medium") or sn.get("thumbnails", {}).get("default") or {}).get("url"),
+            "url": f"https://www.youtube.com/watch?v={vid}",
+        })
+    return results
+
+_ISO_DURATION_RE = re.compile(
+    r"^P(?:(?P<days>\d+)D)?(?:T(?:(?P<hours>\d+)H)?(?:(?P<minutes>\d+)M)?(?:(?P<seconds>\d+)S)?)?$"
+)
+
+def parse_iso_duration(value: str) -> Optional[int]:
+    """Переводит длительность ISO 8601 (PT4M13S) в секунды"""
+    m = _ISO_DURATION_RE.match(value or "")
+    if not m:
+        return None
+    parts = {k: int(v or 0) for k, v in m.groupdict().items()}
+    return ((parts["days"] * 24 + parts["hours"]) * 60 + parts["minutes"]) * 60 + parts["seconds"]
+
+def get_video_details(video_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Длительность и статистика для списка видео одним запросом videos.list
+    (1 единица квоты на пачку до 50 id)
+    """
+    details = {}
+    for i in range(0, len(video_ids), 50):
+        batch = video_ids[i:i + 50]
+        params = {
+            "part": "contentDetails,statistics",
+            "id": ",".join(batch),
+        }
+        data = _youtube_api_get("videos", params, f"деталей {len(batch)} видео")
+        if data is None:
+            continue
+        for item in data.get("items", []):
+            cd = item.get("contentDetails", {})
+            st = item.get("statistics", {})
+            details[item["id"]] = {
+                "duration": parse_iso_duration(cd.get("duration")),
+                "view_count": int(st.get("viewCount", 0) or 0),
+                "like_count": int(st.get("likeCount", 0) or 0),
+            }
+    return details
+
+def _youtube_api_get(endpoint: str, params: Dict[str, Any], context: str) -> Optional[Dict[str, Any]]:
+    """Запрос к YouTube Data API с автоматической ротацией ключей. None - при ошибке"""
     
     # Пробуем все доступные ключи
     for attempt in range(key_manager.get_available_keys_count() + 1):
         current_key = key_manager.get_current_key()
         if not current_key:
             print("❌ Нет доступных ключей YouTube API")
-            return []
-        
-        params = {
-            "part": "snippet",
-            "q": query,
-            "maxResults": limit,
-            "type": "video",
-            "key": current_key,
-            "safeSearch": "none",
-            "relevanceLanguage": "en",
-        }
+            return None
 
         try:
-            resp = requests.get("https://www.googleapis.com/youtube/v3/search", params=params, timeout=15)
+            resp = requests.get(
+                f"https://www.googleapis.com/youtube/v3/{endpoint}",
+                params={**params, "key": current_key},
+                timeout=15,
+            )
             
             # Проверяем статус ответа
             if resp.status_code == 200:
@@ -82,25 +141,13 @@ def _search_youtube_single(query: str, limit: int) -> List[Dict[str, Any]]:
                         key_manager.mark_key_failed(current_key, f"Код {error_code}: {error_message}")
                         continue  # Пробуем следующий ключ
                     else:
-                        print(f"❌ YouTube API вернул ошибку для запроса '{query}':")
+                        print(f"❌ YouTube API вернул ошибку для {context}:")
                         print(f"   Код: {error_code}")
                         print(f"   Сообщение: {error_message}")
-                        return []
+                        return None
                 
                 # Успешный ответ
-                results = []
-                for item in data.get("items", []):
-                    vid = item["id"]["videoId"]
-                    sn = item["snippet"]
-                    results.append({
-                        "video_id": vid,
-                        "title": sn.get("title"),
-                        "channel": sn.get("channelTitle"),
-                        "published_at": sn.get("publishedAt"),
-                        "thumbnail": (sn.get("thumbnails", {}).get("medium") or sn.get("thumbnails", {}).get("default") or {}).get("url"),
-                        "url": f"https://www.youtube.com/watch?v={vid}",
-                    })
-                return results
+                return data
                 
             elif resp.status_code == 403:
                 # Ключ заблокирован или превышена квота
@@ -115,16 +162,16 @@ def _search_youtube_single(query: str, limit: int) -> List[Dict[str, Any]]:
                 continue  # Пробуем следующий ключ
                 
             else:
-                print(f"❌ Неожиданный статус YouTube API для запроса '{query}': {resp.status_code}")
-                return []
+                print(f"❌ Неожиданный статус YouTube API для {context}: {resp.status_code}")
+                return None
                 
         except requests.exceptions.RequestException as e:
-            print(f"❌ Ошибка сети при поиске YouTube для запроса '{query}': {e}")
-            return []
+            print(f"❌ Ошибка сети при запросе YouTube для {context}: {e}")
+            return None
         except Exception as e:
-            print(f"❌ Неожиданная ошибка при поиске YouTube для запроса '{query}': {e}")
-            return []
+            print(f"❌ Неожиданная ошибка при запросе YouTube для {context}: {e}")
+            return None
     
     # Если все ключи исчерпаны
-    print(f"❌ Все ключи YouTube API исчерпаны для запроса '{query}'")
+    print(f"❌ Все ключи YouTube API исчерпаны для {context}")
     raise Exception("Упс, похоже закончились ключи. Сообщите об ошибке в Telegram: @Vie333")
@@ -1,8 +1,9 @@
-from typing import Tuple
+from typing import Optional, Tuple
 import re
 import os
-from tempfile import TemporaryDirectory
+import subprocess
 from yt_dlp import YoutubeDL
+from .scratch import scratch_space
 
 _SAFE = re.compile(r'[^\w\- .\[\]\(\)]', re.UNICODE)
 
@@ -67,36 +68,117 @@ def get_direct_audio(video_id: str) -> Tuple[str, str, str]:
         return stream_url, filename, mime
 
 
-def download_mp3(video_id: str, progress_callback=None) -> Tuple[bytes, str]:
+class DownloadCancelled(Exception):
+    """Загрузка прервана, потому что результат больше никому не нужен"""
+
+
+def _convert_to_mp3(src_path: str, dst_path: str, duration: Optional[float] = None,
+                    progress_callback=None, cancel_check=None):
+    """
+    Convert an audio file to MP3 with ffmpeg, reporting real progress.
+    The ffmpeg child is killed as soon as cancel_check() returns True.
+    """
+    cmd = [
+        "ffmpeg", "-hide_banner", "-nostdin", "-loglevel", "error", "-y",
+        "-i", src_path, "-vn",
+        "-codec:a", "libmp3lame", "-b:a", "192k",
+        "-progress", "pipe:1", "-nostats",
+        dst_path,
+    ]
+    # stderr пишем в файл задачи, а не в pipe: пока читаем stdout, переполненный
+    # pipe ошибок заблокировал бы ffmpeg, а вместе с ним и этот цикл
+    stderr_path = os.path.join(os.path.dirname(dst_path), "ffmpeg.log")
+    with open(stderr_path, "wb") as stderr_file:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_file, text=True)
+    try:
+        # ffmpeg пишет блоки key=value примерно каждые полсекунды
+        for line in proc.stdout:
+            if cancel_check and cancel_check():
+                raise DownloadCancelled("Конвертация отменена")
+            key, _, value = line.strip().partition("=")
+            # out_time_ms исторически тоже в микросекундах
+            if key in ("out_time_us", "out_time_ms") and progress_callback:
+                try:
+                    out_time = int(value) / 1_000_000
+                except ValueError:
+                    continue
+                progress_callback({
+                    "status": "converting",
+                    "out_time": out_time,
+                    "duration": duration,
+                })
+        proc.wait()
+        if proc.returncode != 0:
+            error = _read_tail(stderr_path)
+            raise RuntimeError(f"ffmpeg завершился с кодом {proc.returncode}: {error[-200:]}")
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+
+
+def _read_tail(path: str, limit: int = 4096) -> str:
+    """Последние limit байт лога (там обычно причина ошибки)"""
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - limit))
+            return f.read().decode("utf-8", "replace").strip()
+    except OSError:
+        return ""
+
+
+def _estimate_job_bytes(info: dict) -> int:
+    """Оценка места под задачу: исходная дорожка + MP3 192 kbps + запас"""
+    duration = info.get("duration") or 600
+    source = info.get("filesize") or info.get("filesize_approx")
+    if not source:
+        abr = info.get("abr") or info.get("tbr") or 160
+        source = duration * abr * 1000 / 8
+    mp3 = duration * 192 * 1000 / 8
+    return int((source + mp3) * 1.2)
+
+
+def download_mp3(video_id: str, progress_callback=None, cancel_check=None) -> Tuple[bytes, str]:
     """
-    Download audio from YouTube and convert it to MP3 using yt-dlp.
+    Download audio from YouTube and convert it to MP3 using yt-dlp and ffmpeg.
     Returns (data_bytes, filename).
+
+    cancel_check is polled from the download hook and the ffmpeg loop;
+    once it returns True the work is aborted with DownloadCancelled and
+    the temporary files are removed.
+    Raises ScratchSpaceFull if there is no room for the job's temp files.
     """
     url = f"https://www.youtube.com/watch?v={video_id}"
-    with TemporaryDirectory() as tmpdir:
+
+    def hook(d):
+        if cancel_check and cancel_check():
+            raise DownloadCancelled("Загрузка отменена")
+        if progress_callback:
+            progress_callback(d)
+
+    # Сначала только метаданные: по ним оцениваем, сколько места понадобится
+    with YoutubeDL({"quiet": True, "noplaylist": True, "format": "bestaudio/best"}) as ydl:
+        info = ydl.extract_info(url, download=False)
+
+    with scratch_space.job(_estimate_job_bytes(info)) as tmpdir:
         outtmpl = os.path.join(tmpdir, "%(id)s.%(ext)s")
         ydl_opts = {
             "quiet": True,
             "noplaylist": True,
             "format": "bestaudio/best",
             "outtmpl": outtmpl,
-            "postprocessors": [
-                {
-                    "key": "FFmpegExtractAudio",
-                    "preferredcodec": "mp3",
-                    "preferredquality": "192",
-                }
-            ],
+            "progress_hooks": [hook],
         }
-        
-        # Добавляем callback для отслеживания прогресса
-        if progress_callback:
-            ydl_opts["progress_hooks"] = [progress_callback]
-        
+
         with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
+            info = ydl.process_ie_result(info, download=True)
             temp_path = ydl.prepare_filename(info)
         mp3_path = os.path.splitext(temp_path)[0] + ".mp3"
+        # Конвертируем сами, чтобы видеть реальный прогресс ffmpeg и иметь возможность его убить
+        if temp_path != mp3_path:
+            _convert_to_mp3(temp_path, mp3_path, info.get("duration"), progress_callback, cancel_check)
         with open(mp3_path, "rb") as f:
             data = f.read()
     title = info.get("title") or "audio"
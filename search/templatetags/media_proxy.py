@@ -0,0 +1,9 @@
+from django import template
+from ..services.media_cache import proxied_url
+
+register = template.Library()
+
+@register.filter
+def proxied(url, size=None):
+    """Ссылка на превью/обложку через кэширующий прокси: {{ t.image|proxied:112 }}"""
+    return proxied_url(url, int(size) if size else None)
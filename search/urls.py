@@ -3,7 +3,11 @@ from . import views
 
 urlpatterns = [
     path('', views.search_view, name='search'),
+    path('typeahead/', views.typeahead, name='typeahead'),
     path('track/<str:track_id>/', views.track_detail, name='track_detail'),
+    path('track/<str:track_id>/audio/', views.track_audio, name='track_audio'),
     path('youtube/<str:video_id>/audio/', views.youtube_audio, name='youtube_audio'),
     path('youtube/<str:video_id>/progress/', views.progress_stream, name='progress_stream'),
+    path('media-proxy/', views.media_proxy, name='media_proxy'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
@@ -1,17 +1,54 @@
 import re
+import hashlib
 import urllib.parse
 import json
+import errno
+import select
+import socket
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import cache
 from django.shortcuts import render, redirect
-from django.http import HttpRequest, HttpResponse, Http404, StreamingHttpResponse
+from django.urls import reverse
+from django.http import (
+    HttpRequest, HttpResponse, Http404, StreamingHttpResponse, JsonResponse, FileResponse,
+)
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from django.views.decorators.csrf import csrf_exempt
 from .forms import SearchForm
 from .services.spotify import search_tracks, get_track_metadata
-from .services.youtube import search_youtube
-from .services.ytdl import download_mp3
+from .services.track_index import track_index
+from .services.media_cache import (
+    media_cache, proxied_url, is_allowed_url, MediaFetchError, ALLOWED_SIZES,
+)
+from .services.matching import find_youtube_matches, get_best_match
+from .services.ytdl import download_mp3, DownloadCancelled
+from .services.scratch import ScratchSpaceFull
 from .services.youtube_key_manager import key_manager
+from .services.metrics import metrics
+from .services.page_cache import cached_page
+from .services.ratelimit import (
+    rate_limiter, transcode_scheduler, get_client_id, QueueFull, QueueTimeout,
+)
 
-# Глобальный словарь для хранения прогресса
+# Глобальный словарь для хранения прогресса: {job_key: {...}}
 download_progress = {}
+# Время жизни кэша страниц и результатов поиска (секунды)
+SEARCH_RESULTS_TIMEOUT = 600
+SEARCH_PAGE_TIMEOUT = 600
+TRACK_PAGE_TIMEOUT = 600
+
+# Прогресс и активные загрузки хранятся по ключу "<video_id>:<token>",
+# token генерирует страница для каждой загрузки
+# Активные загрузки: {job_key: {'event': threading.Event, 'reason': str}}
+active_downloads = {}
+# Когда загрузка получила итоговый статус: {job_key: time.monotonic()}.
+# Если поток прогресса так и не забрал результат, запись удаляется через PROGRESS_RESULT_TTL
+_progress_finished_at = {}
+PROGRESS_RESULT_TTL = 300
 
 _SPOTIFY_URL_RE = re.compile(
     r"""
@@ -49,58 +86,237 @@ def ms_to_mmss(ms) -> str:
     m, ss = divmod(s, 60)
     return f"{m}:{ss:02d}"
 
+def _search_tracks_cached(query: str):
+    """search_tracks с кэшем по нормализованному запросу: «Numb » и «numb» - один запрос к Spotify"""
+    normalized = " ".join(query.split()).casefold()
+    cache_key = f"search_results:{hashlib.sha256(normalized.encode()).hexdigest()}"
+    results = cache.get(cache_key)
+    if results is None:
+        results = search_tracks(query, limit=12)
+        # Пустой ответ может означать ошибку Spotify, его держим недолго
+        cache.set(cache_key, results, SEARCH_RESULTS_TIMEOUT if results else 30)
+    return results
+
 def search_view(request: HttpRequest) -> HttpResponse:
     form = SearchForm(request.GET or None)
-    results = []
-    query = None
-    error = None
-    if form.is_valid():
-        query = form.cleaned_data["q"]
-        # 1) Если вставили ссылку/URI/ID трека — сразу на детальную
-        track_id = extract_spotify_track_id(query)
-        if track_id:
-            return redirect("track_detail", track_id=track_id)
-        # 2) Иначе — обычный текстовый поиск
+    if not request.GET:
+        # Стартовая страница одинакова для всех
+        return cached_page(
+            request, 'search', '',
+            lambda: ({"form": form, "results": [], "query": None, "error": None}, 3600, None),
+            "search/search.html", max_age=3600,
+        )
+    if not form.is_valid():
+        context = {"form": form, "results": [], "query": None, "error": None}
+        return render(request, "search/search.html", context)
+
+    query = form.cleaned_data["q"]
+    # 1) Если вставили ссылку/URI/ID трека — сразу на детальную
+    track_id = extract_spotify_track_id(query)
+    if track_id:
+        return redirect("track_detail", track_id=track_id)
+
+    # 2) Иначе — обычный текстовый поиск
+    def build():
+        limited = rate_limiter.check(request, 'search')
+        if limited:
+            return limited
+        results = []
+        error = None
         try:
-            results = search_tracks(query, limit=12)
+            results = _search_tracks_cached(query)
             for t in results:
                 t["duration_str"] = ms_to_mmss(t.get("duration_ms"))
         except Exception as e:
             error = str(e)
-    context = {"form": form, "results": results, "query": query, "error": error}
-    return render(request, "search/search.html", context)
+        context = {"form": form, "results": results, "query": query, "error": error}
+        etag_data = {
+            "query": query,
+            "error": error,
+            "tracks": [
+                [t.get("id"), t.get("name"), t.get("artists"), t.get("album"), t.get("duration_ms")]
+                for t in results
+            ],
+        }
+        return context, (0 if error else SEARCH_PAGE_TIMEOUT if results else 30), etag_data
 
-def track_detail(request: HttpRequest, track_id: str) -> HttpResponse:
-    try:
-        meta = get_track_metadata(track_id)
-    except Exception as e:
-        raise Http404(f"Spotify трек не найден или недоступен: {e}")
+    return cached_page(request, 'search', query, build, "search/search.html", max_age=60)
 
-    meta["duration_str"] = ms_to_mmss(meta.get("duration_ms"))
-    yt_query = f"{meta['artists']} - {meta['name']}"
-    yt_results = []
-    yt_error = None
+def typeahead(request: HttpRequest) -> JsonResponse:
+    """Подсказки по мере ввода: сначала локальный индекс, Spotify - только при промахе"""
+    query = (request.GET.get("q") or "").strip()[:100]
+    if len(query) < 2:
+        return JsonResponse({"query": query, "source": "none", "results": []})
+
+    started = time.perf_counter()
+    source = "index"
     try:
-        yt_results = search_youtube(yt_query, limit=6)
+        results = track_index.search(query, limit=8)
     except Exception as e:
-        yt_error = str(e)
+        print(f"Ошибка поиска по индексу: {e}")
+        results = []
+    metrics.incr('typeahead_index_hits' if results else 'typeahead_index_misses')
+
+    if not results:
+        # Свой лимит, чтобы набор текста не расходовал лимит настоящего поиска;
+        # при превышении просто отвечаем без подсказок
+        if rate_limiter.check(request, 'typeahead'):
+            source = "limited"
+        else:
+            source = "spotify"
+            # search_tracks сам добавит найденное в индекс
+            results = search_tracks(query, limit=8)
+
+    for t in results:
+        t["duration_str"] = ms_to_mmss(t.get("duration_ms"))
+        t["url"] = reverse("track_detail", args=[t["id"]])
+        t["image"] = proxied_url(t.get("image"), 72)
+    return JsonResponse({
+        "query": query,
+        "source": source,
+        "took_ms": round((time.perf_counter() - started) * 1000, 2),
+        "results": [
+            {k: t.get(k) for k in ("id", "name", "artists", "album", "image", "duration_str", "url")}
+            for t in results
+        ],
+    })
+
+def track_detail(request: HttpRequest, track_id: str) -> HttpResponse:
+    def build():
+        limited = rate_limiter.check(request, 'track')
+        if limited:
+            return limited
+        try:
+            meta = get_track_metadata(track_id)
+        except Exception as e:
+            raise Http404(f"Spotify трек не найден или недоступен: {e}")
+
+        meta["duration_str"] = ms_to_mmss(meta.get("duration_ms"))
+        yt_query = f"{meta['artists']} - {meta['name']}"
         yt_results = []
-        # Если это сообщение о закончившихся ключах, не показываем другие ошибки
-        if "закончились ключи" in str(e):
+        yt_error = None
+        try:
+            yt_results = find_youtube_matches(meta, limit=6)
+            for v in yt_results:
+                v["duration_str"] = ms_to_mmss(v["duration"] * 1000) if v.get("duration") is not None else None
+        except Exception as e:
             yt_error = str(e)
-    context = {
-        "meta": meta, 
-        "yt_query": yt_query, 
-        "yt_results": yt_results, 
-        "yt_error": yt_error
-    }
-    return render(request, "search/track_detail.html", context)
+            yt_results = []
+            # Если это сообщение о закончившихся ключах, не показываем другие ошибки
+            if "закончились ключи" in str(e):
+                yt_error = str(e)
+        context = {
+            "meta": meta, 
+            "yt_query": yt_query, 
+            "yt_results": yt_results, 
+            "yt_error": yt_error
+        }
+        # В ETag - только стабильные поля: подписанный preview_url и просмотры меняются
+        etag_data = {
+            "track": [meta.get(k) for k in ("id", "name", "artists", "album", "release_date",
+                                             "duration_ms", "explicit")],
+            "has_preview": bool(meta.get("preview_url")),
+            "videos": [v["video_id"] for v in yt_results],
+            "yt_error": yt_error,
+        }
+        # Страницу с ошибкой YouTube не кэшируем, чтобы она не пережила восстановление ключей
+        return context, (0 if yt_error else TRACK_PAGE_TIMEOUT), etag_data
+
+    return cached_page(request, 'track_detail', track_id, build, "search/track_detail.html", max_age=300)
+
+def _client_disconnected(request: HttpRequest) -> bool:
+    """Проверить, не закрыл ли клиент соединение (работает под gunicorn)"""
+    sock = request.META.get("gunicorn.socket")
+    if sock is None:
+        return False
+    # poll, а не select: select не работает с дескрипторами >= 1024
+    try:
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        if not poller.poll(0):
+            return False
+    except (OSError, ValueError):
+        # Не удалось проверить - это ещё не повод отменять загрузку
+        return False
+    try:
+        # Тело GET-запроса уже прочитано, значит читаемый сокет с пустыми данными - это EOF
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+    except (ConnectionResetError, BrokenPipeError):
+        return True
+    except OSError as e:
+        return e.errno in (errno.ECONNRESET, errno.EPIPE)
+
+_TOKEN_RE = re.compile(r"^[A-Za-z0-9-]{8,64}$")
+
+def _download_token(request: HttpRequest):
+    """Токен, которым страница связывает запрос /audio/ со своим потоком /progress/"""
+    token = request.GET.get("token", "")
+    return token if _TOKEN_RE.match(token) else None
+
+def _mark_progress_finished(job_key: str):
+    """Запомнить, что у задачи итоговый статус, и убрать давно никем не прочитанные"""
+    now = time.monotonic()
+    _progress_finished_at[job_key] = now
+    for key, finished_at in list(_progress_finished_at.items()):
+        if now - finished_at > PROGRESS_RESULT_TTL:
+            _progress_finished_at.pop(key, None)
+            download_progress.pop(key, None)
+
+def _cancel_download(job_key: str, reason: str):
+    """Попросить загрузку конкретного клиента остановиться"""
+    job = active_downloads.get(job_key)
+    if job and not job['event'].is_set():
+        job['reason'] = reason
+        job['event'].set()
 
 def youtube_audio(request: HttpRequest, video_id: str) -> HttpResponse:
     """Download YouTube audio and return it as an MP3 file."""
+    limited = rate_limiter.check(request, 'audio')
+    if limited:
+        # Страница уже слушает /progress/ - сообщаем ей об отказе, иначе поток будет ждать вечно
+        token = _download_token(request)
+        if token:
+            download_progress[f"{video_id}:{token}"] = {
+                'status': 'error',
+                'progress': 0,
+                'message': limited.content.decode()
+            }
+            _mark_progress_finished(f"{video_id}:{token}")
+        return limited
+    return _serve_audio(request, video_id)
+
+def track_audio(request: HttpRequest, track_id: str) -> HttpResponse:
+    """Download audio of the best YouTube match for a Spotify track."""
+    limited = rate_limiter.check(request, 'audio')
+    if limited:
+        return limited
+    try:
+        meta = get_track_metadata(track_id)
+        best = get_best_match(meta)
+    except Exception as e:
+        return HttpResponse(f"Не удалось подобрать видео: {e}", status=502)
+    if not best:
+        raise Http404("Подходящее видео на YouTube не найдено")
+    return _serve_audio(request, best["video_id"])
+
+def _serve_audio(request: HttpRequest, video_id: str) -> HttpResponse:
+    token = _download_token(request)
+    # Без токена прогресс никто не читает: даём задаче уникальный ключ,
+    # чтобы она не пересекалась с загрузками того же видео у других клиентов
+    job_key = f"{video_id}:{token}" if token else f"{video_id}:{uuid.uuid4().hex}"
+    job = {'event': threading.Event(), 'reason': None}
+    active_downloads[job_key] = job
+    metrics.incr('downloads_started')
+
+    def should_cancel():
+        if not job['event'].is_set() and _client_disconnected(request):
+            job['reason'] = 'client_disconnect'
+            job['event'].set()
+        return job['event'].is_set()
+
     try:
         # Инициализируем прогресс
-        download_progress[video_id] = {
+        download_progress[job_key] = {
             'status': 'starting',
             'progress': 0,
             'message': 'Начинаем загрузку...'
@@ -109,61 +325,107 @@ def youtube_audio(request: HttpRequest, video_id: str) -> HttpResponse:
         # Создаем кастомный callback для отслеживания прогресса
         def progress_callback(d):
             if d['status'] == 'downloading':
-                # Вычисляем процент прогресса
+                # Загрузка занимает первые 90%, конвертация - оставшиеся
                 if 'total_bytes' in d and d['total_bytes']:
-                    progress = int((d['downloaded_bytes'] / d['total_bytes']) * 100)
+                    progress = int((d['downloaded_bytes'] / d['total_bytes']) * 90)
                 elif 'total_bytes_estimate' in d and d['total_bytes_estimate']:
-                    progress = int((d['downloaded_bytes'] / d['total_bytes_estimate']) * 100)
+                    progress = int((d['downloaded_bytes'] / d['total_bytes_estimate']) * 90)
                 else:
                     progress = 0
                 
-                download_progress[video_id] = {
+                download_progress[job_key] = {
                     'status': 'downloading',
-                    'progress': progress,
+                    'progress': min(progress, 90),
                     'message': f'Загружено {d.get("downloaded_bytes", 0)} байт'
                 }
             elif d['status'] == 'finished':
-                download_progress[video_id] = {
+                download_progress[job_key] = {
                     'status': 'processing',
-                    'progress': 95,
+                    'progress': 90,
+                    'message': 'Обрабатываем аудио...'
+                }
+            elif d['status'] == 'converting':
+                progress = 90
+                if d.get('duration'):
+                    progress += int(min(d['out_time'] / d['duration'], 1.0) * 9)
+                download_progress[job_key] = {
+                    'status': 'processing',
+                    'progress': progress,
                     'message': 'Обрабатываем аудио...'
                 }
-                
-                # Добавляем промежуточные обновления во время обработки
-                import threading
-                import time
-                
-                def update_processing_progress():
-                    for i in range(96, 100):
-                        time.sleep(0.5)  # Обновляем каждые 500мс
-                        if video_id in download_progress and download_progress[video_id]['status'] == 'processing':
-                            download_progress[video_id] = {
-                                'status': 'processing',
-                                'progress': i,
-                                'message': 'Обрабатываем аудио...'
-                            }
-                
-                # Запускаем обновления в отдельном потоке
-                threading.Thread(target=update_processing_progress, daemon=True).start()
         
-        # Скачиваем с отслеживанием прогресса
-        data, filename = download_mp3(video_id, progress_callback)
+        # Ждём своей очереди на загрузку и транскодирование
+        download_progress[job_key] = {
+            'status': 'queued',
+            'progress': 0,
+            'message': 'Ожидание в очереди...'
+        }
+        acquired = transcode_scheduler.acquire(
+            get_client_id(request),
+            timeout=getattr(settings, 'TRANSCODE_QUEUE_TIMEOUT', 120),
+            cancel_check=should_cancel,
+        )
+        if not acquired:
+            raise DownloadCancelled("Отменено в очереди")
+        try:
+            # Скачиваем с отслеживанием прогресса
+            data, filename = download_mp3(video_id, progress_callback, cancel_check=should_cancel)
+        finally:
+            transcode_scheduler.release()
         
         # Обновляем прогресс на завершение
-        download_progress[video_id] = {
+        download_progress[job_key] = {
             'status': 'completed',
             'progress': 100,
             'message': 'Загрузка завершена'
         }
+        metrics.incr('downloads_completed')
         
+    except DownloadCancelled:
+        reason = job['reason'] or 'unknown'
+        download_progress[job_key] = {
+            'status': 'cancelled',
+            'progress': 0,
+            'message': 'Загрузка отменена'
+        }
+        metrics.incr('downloads_cancelled')
+        metrics.incr(f'downloads_cancelled_{reason}')
+        print(f"⏹ Загрузка {video_id} отменена ({reason})")
+        return HttpResponse("Загрузка отменена", status=499)
+    except (QueueFull, QueueTimeout, ScratchSpaceFull) as e:
+        if isinstance(e, QueueFull):
+            message = "У вас уже есть загрузки в очереди. Дождитесь их завершения."
+            status = 429
+        elif isinstance(e, ScratchSpaceFull):
+            message = "На сервере временно не хватает места. Попробуйте позже."
+            status = 503
+        else:
+            message = "Сервер занят другими загрузками. Попробуйте позже."
+            status = 503
+        download_progress[job_key] = {
+            'status': 'error',
+            'progress': 0,
+            'message': message
+        }
+        resp = HttpResponse(message, status=status, content_type="text/plain; charset=utf-8")
+        resp["Retry-After"] = "30"
+        return resp
     except Exception as e:
         # Обновляем прогресс на ошибку
-        download_progress[video_id] = {
+        download_progress[job_key] = {
             'status': 'error',
             'progress': 0,
             'message': f'Ошибка: {str(e)}'
         }
+        metrics.incr('downloads_failed')
         return HttpResponse(f"Не удалось получить аудио: {e}", status=502)
+    finally:
+        active_downloads.pop(job_key, None)
+        if not token or job['reason'] == 'sse_abandoned':
+            # Поток прогресса уже закрыт - итоговый статус читать некому
+            download_progress.pop(job_key, None)
+        else:
+            _mark_progress_finished(job_key)
 
     # Очищаем имя файла от недопустимых символов
     safe_filename = re.sub(r'[<>:"/\\|?*]', '_', filename)
@@ -183,26 +445,134 @@ def youtube_audio(request: HttpRequest, video_id: str) -> HttpResponse:
     resp["X-Content-Type-Options"] = "nosniff"
     return resp
 
+# Сколько ждать появления загрузки, прежде чем закрыть поток прогресса
+PROGRESS_WAIT_TIMEOUT = 60
+# Интервал keep-alive комментариев: запись в сокет позволяет заметить ушедшего клиента
+PROGRESS_KEEPALIVE_INTERVAL = 15
+
 @csrf_exempt
 def progress_stream(request, video_id):
     """Stream progress updates for download"""
+    token = _download_token(request)
+    job_key = f"{video_id}:{token}" if token else video_id
+
     def event_stream():
-        while True:
-            if video_id in download_progress:
-                progress = download_progress[video_id]
-                yield f"data: {json.dumps(progress)}\n\n"
-                
-                # Закрываем соединение только при полном завершении или ошибке
-                if progress.get('status') in ['completed', 'error']:
-                    # Удаляем прогресс после завершения
-                    if video_id in download_progress:
-                        del download_progress[video_id]
+        finished = False
+        started = last_write = time.monotonic()
+        seen = False
+        try:
+            while True:
+                now = time.monotonic()
+                if job_key in download_progress:
+                    seen = True
+                    progress = download_progress[job_key]
+                    yield f"data: {json.dumps(progress)}\n\n"
+                    last_write = now
+                    
+                    # Закрываем соединение только при полном завершении, ошибке или отмене
+                    if progress.get('status') in ['completed', 'error', 'cancelled']:
+                        finished = True
+                        # Удаляем прогресс после завершения
+                        download_progress.pop(job_key, None)
+                        _progress_finished_at.pop(job_key, None)
+                        break
+                elif not seen and now - started > PROGRESS_WAIT_TIMEOUT:
+                    # Запрос на загрузку так и не пришёл
+                    finished = True
+                    yield "data: " + json.dumps({
+                        'status': 'error',
+                        'progress': 0,
+                        'message': 'Загрузка не началась'
+                    }) + "\n\n"
                     break
-            
-            import time
-            time.sleep(0.1)  # Проверяем каждые 100мс
+                elif now - last_write > PROGRESS_KEEPALIVE_INTERVAL:
+                    yield ": keep-alive\n\n"
+                    last_write = now
+                
+                time.sleep(0.1)  # Проверяем каждые 100мс
+        finally:
+            # Клиент ушёл, не дождавшись результата - загрузка больше не нужна
+            if not finished:
+                _cancel_download(job_key, 'sse_abandoned')
     
     response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
     response['Cache-Control'] = 'no-cache'
     response['X-Accel-Buffering'] = 'no'
     return response
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def media_proxy(request: HttpRequest) -> HttpResponse:
+    """Превью и обложки со сторонних CDN через дисковый кэш (ETag, Last-Modified, Range)"""
+    url = request.GET.get("url", "")
+    if not is_allowed_url(url):
+        return HttpResponse("Недопустимый URL", status=400)
+    try:
+        size = int(request.GET.get("size") or 0) or None
+    except ValueError:
+        size = None
+    if size not in ALLOWED_SIZES:
+        size = None
+
+    # Файл может вытеснить другой воркер между проверкой и открытием - тогда скачиваем заново
+    for attempt in range(2):
+        try:
+            path, meta = media_cache.get(url, size)
+            f = open(path, "rb")
+            break
+        except MediaFetchError as e:
+            return HttpResponse(f"Не удалось получить файл: {e}", status=502)
+        except FileNotFoundError:
+            if attempt:
+                return HttpResponse("Не удалось получить файл", status=502)
+
+    etag = meta["etag"]
+    last_modified = int(meta["last_modified"])
+    headers = {
+        "ETag": etag,
+        "Last-Modified": http_date(last_modified),
+        "Cache-Control": "public, max-age=604800",
+        "Accept-Ranges": "bytes",
+    }
+
+    # Условный GET - так же, как в page_cache: If-None-Match (слабое сравнение)
+    # важнее If-Modified-Since, в 304 попадают ETag, Last-Modified и Cache-Control
+    probe = HttpResponse()
+    for k, v in headers.items():
+        probe[k] = v
+    conditional = get_conditional_response(request, etag=etag, last_modified=last_modified, response=probe)
+    if conditional is not probe:
+        f.close()
+        return conditional
+
+    total = meta["size"]
+    range_header = request.META.get("HTTP_RANGE", "")
+    if_range = request.META.get("HTTP_IF_RANGE")
+    m = _RANGE_RE.match(range_header.strip())
+    if m and (not if_range or if_range == etag) and (m.group(1) or m.group(2)):
+        if m.group(1):
+            start = int(m.group(1))
+            end = min(int(m.group(2)), total - 1) if m.group(2) else total - 1
+        else:
+            # bytes=-N - последние N байт
+            start = max(total - int(m.group(2)), 0)
+            end = total - 1
+        if start > end or start >= total:
+            f.close()
+            resp = HttpResponse(status=416)
+            resp["Content-Range"] = f"bytes */{total}"
+            return resp
+        with f:
+            f.seek(start)
+            chunk = f.read(end - start + 1)
+        resp = HttpResponse(chunk, status=206, content_type=meta["content_type"])
+        resp["Content-Range"] = f"bytes {start}-{end}/{total}"
+    else:
+        resp = FileResponse(f, content_type=meta["content_type"])
+    for k, v in headers.items():
+        resp[k] = v
+    return resp
+
+def metrics_view(request: HttpRequest) -> JsonResponse:
+    """Текущие метрики процесса"""
+    return JsonResponse(metrics.snapshot())